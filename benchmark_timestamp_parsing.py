@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Benchmark of the fixed format weblog timestamp parser against per row strptime parsing
+
+Usage: benchmark_timestamp_parsing.py [--number_of_logs =<number_of_logs>]
+
+Options:
+--number_of_logs =<number_of_logs>  (Optional argument) The number of log timestamps to parse [default: 100000]
+"""
+
+import random
+import time
+import pytz
+import pandas as pd
+from datetime import datetime
+from docopt import docopt
+from transform_logs_load import parse_weblog_timestamps
+
+opt = docopt(__doc__)
+
+def generate_log_timestamps(number_of_logs):
+    """ Timestamp and timezone log fields in the format written by create_weblogs.py """
+    log_timestamps = []
+    for i in range(number_of_logs):
+        generate_random_login_time = datetime(random.choice([2019, 2020, 2021, 2022]), random.choice([m for m in range(1, 13) if m!=2]), random.choice(range(1, 31)), random.choice(range(24)), random.choice(range(60)), random.choice(range(60)))
+        timezone = pytz.timezone(random.choice(pytz.common_timezones))
+        log_timestamps.append(timezone.localize(generate_random_login_time).strftime("[%d/%B/%Y:%H:%M:%S %z]").split(' '))
+
+    return pd.DataFrame(log_timestamps, columns=['timestamp', 'timezone'])
+
+def parse_with_strptime(timestamp, timezone):
+    """ Naive approach, strptime on every row """
+    return pd.Series([datetime.strptime(t + ' ' + z, "[%d/%B/%Y:%H:%M:%S %z]") for t, z in zip(timestamp, timezone)], index=timestamp.index).pipe(pd.to_datetime, utc=True)
+
+def parse_with_to_datetime(timestamp, timezone):
+    """ pandas to_datetime with an explicit format """
+    return pd.to_datetime(timestamp + ' ' + timezone, format="[%d/%B/%Y:%H:%M:%S %z]", utc=True)
+
+def main(number_of_logs):
+    if number_of_logs is None:
+        number_of_logs = 100000
+    log_timestamps = generate_log_timestamps(int(number_of_logs))
+
+    parsers = [
+        ('strptime per row', parse_with_strptime),
+        ('pandas to_datetime with format', parse_with_to_datetime),
+        ('fixed format parser', parse_weblog_timestamps)
+    ]
+
+    expected = None
+    for parser_name, parser in parsers:
+        start = time.perf_counter()
+        parsed = parser(log_timestamps['timestamp'], log_timestamps['timezone'])
+        elapsed = time.perf_counter() - start
+
+        if expected is None:
+            expected = parsed
+        assert (parsed == expected).all(), f"{parser_name} parsed timestamps differently"
+
+        print(f"{parser_name:<32}{elapsed:8.3f} s  {len(log_timestamps) / elapsed:12,.0f} rows/s")
+
+if __name__ == "__main__":
+    main(opt["--number_of_logs"])
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Benchmark of the weblogs and taxi service loads and the report queries on every target datawarehouse backend
+
+Loads weblogs.log and the taxi service database into a scratch 'benchmark' database of each backend, then times the report queries.
+
+Usage: benchmark_warehouse_backends.py [--backends =<backends>] [--repeat =<repeat>]
+
+Options:
+--backends =<backends>  (Optional argument) Comma separated warehouse backends to benchmark [default: postgresql,duckdb]
+--repeat =<repeat>      (Optional argument) The number of runs of every report query, the median is reported [default: 5]
+"""
+
+import os
+import time
+import statistics
+from docopt import docopt
+from warehouse_backends import create_warehouse_engine, WAREHOUSE_PATH
+from transform_logs_load import load_logs_to_dw
+from transform_taxiservice_load import transform_taxiservice_tables, load_taxiservice_to_dw
+
+# Scratch database the weblogs are loaded into
+BENCHMARK_DATABASE = 'benchmark'
+
+# Report queries over the raw weblogs and the report views
+REPORT_QUERIES = [
+    ('top 5 login devices, raw weblogs', """
+        SELECT client_device, COUNT(*) AS n_logins
+        FROM dbo.user_weblogs
+        GROUP BY 1
+        ORDER BY 2 DESC
+        LIMIT 5
+        """),
+    ('logins per country, one month', """
+        SELECT country, COUNT(*) AS n_logins
+        FROM dbo.user_weblogs
+        WHERE login_time >= '2021-06-01' AND login_time < '2021-07-01'
+        GROUP BY 1
+        """),
+    ('top 5 login devices, report view', """
+        SELECT * FROM dbo.vw_top5_driver_login_device
+        """),
+    ('working drivers license expiry, report view', """
+        SELECT * FROM dbo.vw_working_driver_expirylicense
+        """),
+    ('percentage canceled rides, report view', """
+        SELECT * FROM dbo.vw_percentage_canceled_rides
+        """)
+]
+
+
+def reset_benchmark_database(backend):
+    """ Empty benchmark database of the backend """
+    if backend == 'duckdb':
+        database_file = os.path.join(WAREHOUSE_PATH, f"{BENCHMARK_DATABASE}.duckdb")
+        if os.path.exists(database_file):
+            os.remove(database_file)
+        return create_warehouse_engine(BENCHMARK_DATABASE, backend)
+
+    server_engine = create_warehouse_engine(os.environ.get("DB_NAME"), backend)
+    with server_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        exists = conn.execute(f"SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{BENCHMARK_DATABASE}'").fetchone()
+        if not exists:
+            conn.execute(f"CREATE DATABASE {BENCHMARK_DATABASE}")
+
+    engine = create_warehouse_engine(BENCHMARK_DATABASE, backend)
+    with engine.begin() as conn:
+        conn.execute("DROP SCHEMA IF EXISTS dbo CASCADE; CREATE SCHEMA dbo")
+    return engine
+
+
+def time_report_query(engine, query, repeat):
+    """ Median elapsed seconds of the query over repeat runs """
+    elapsed = []
+    for i in range(repeat):
+        with engine.connect() as conn:
+            start = time.perf_counter()
+            conn.execute(query).fetchall()
+            elapsed.append(time.perf_counter() - start)
+
+    return statistics.median(elapsed)
+
+
+def main(backends, repeat):
+    if backends is None:
+        backends = 'postgresql,duckdb'
+    if repeat is None:
+        repeat = 5
+    backends = [backend.strip() for backend in backends.split(',')]
+    repeat = int(repeat)
+
+    # Taxi service data is extracted once from its source database and loaded into every backend
+    transformed_taxi_service_orders = transform_taxiservice_tables(create_warehouse_engine('taxi_service', 'postgresql'))
+
+    for backend in backends:
+        engine = reset_benchmark_database(backend)
+
+        start = time.perf_counter()
+        load_logs_to_dw(engine)
+        print(f"{backend:<12}{'weblogs load':<44}{time.perf_counter() - start:10.3f} s")
+
+        start = time.perf_counter()
+        load_taxiservice_to_dw(transformed_taxi_service_orders, engine)
+        print(f"{backend:<12}{'taxi service load':<44}{time.perf_counter() - start:10.3f} s")
+
+        for query_name, query in REPORT_QUERIES:
+            print(f"{backend:<12}{query_name:<44}{time_report_query(engine, query, repeat):10.3f} s")
+
+        engine.dispose()
+
+if __name__ == "__main__":
+    opt = docopt(__doc__)
+    main(opt["--backends"], opt["--repeat"])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Chunk level checkpoints to let restarted ETL jobs resume mid-job"""
+
+import os
+from datetime import datetime
+from sqlalchemy import text
+
+# Job details are set by etl_job_run.py for every job it runs
+ETL_JOB_ID = os.environ.get("ETL_JOB_ID")
+ETL_JOB_RUN_ID = os.environ.get("ETL_JOB_RUN_ID")
+
+
+def checkpoints_enabled():
+    """ Checkpoints are only kept when the job is run by the orchestrator """
+    return ETL_JOB_ID is not None and ETL_JOB_RUN_ID is not None
+
+
+def get_last_checkpoint(engine):
+    """ Returns (chunk_index, source_offset) of the last committed chunk of this job run, None if there is none """
+    if not checkpoints_enabled():
+        return None
+
+    # On an embedded warehouse the checkpoints live next to the loaded chunks, in the warehouse file
+    with engine.begin() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS dbo.etl_jobs_checkpoint (
+                    job_id INTEGER NOT NULL,
+                    job_run_id VARCHAR(255) NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    source_offset BIGINT NOT NULL,
+                    last_updated_time TIMESTAMP,
+                    PRIMARY KEY (job_id, job_run_id)
+                    )
+            """)
+
+    query = text(""" SELECT chunk_index, source_offset FROM dbo.etl_jobs_checkpoint WHERE job_id = :job_id AND job_run_id = :job_run_id """)
+    with engine.begin() as conn:
+        result = conn.execute(query, {"job_id": int(ETL_JOB_ID), "job_run_id": ETL_JOB_RUN_ID})
+        checkpoint = result.fetchone()
+
+    return None if checkpoint is None else (checkpoint[0], checkpoint[1])
+
+
+def save_checkpoint(conn, chunk_index, source_offset):
+    """ Records the last committed chunk, must be called within the transaction that loads the chunk """
+    if not checkpoints_enabled():
+        return
+
+    query = text("""
+        INSERT INTO dbo.etl_jobs_checkpoint (job_id, job_run_id, chunk_index, source_offset, last_updated_time)
+        VALUES (:job_id, :job_run_id, :chunk_index, :source_offset, :last_updated_time)
+        ON CONFLICT (job_id, job_run_id) DO UPDATE
+        SET chunk_index = EXCLUDED.chunk_index,
+            source_offset = EXCLUDED.source_offset,
+            last_updated_time = EXCLUDED.last_updated_time
+        """)
+    conn.execute(query, {"job_id": int(ETL_JOB_ID), "job_run_id": ETL_JOB_RUN_ID, "chunk_index": chunk_index, "source_offset": source_offset, "last_updated_time": datetime.now()})
@@ -14,10 +14,20 @@ Options:
 
 import pandas as pd
 import psycopg2
+from psycopg2 import sql
+import hashlib
 import logging
+import math
+import sys
+import threading
+from collections import deque
 import uuid
 from dotenv import load_dotenv
 import os
+import resource
+import signal
+import subprocess
+import time
 from datetime import datetime
 from docopt import docopt
 
@@ -33,6 +43,233 @@ DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PORT = os.environ.get("DB_PORT")
 
+# Columns of etl_jobs_logging
+JOB_COLUMNS = ['job_id', 'job_name', 'job_query', 'active_flag', 'timeout_seconds', 'max_memory_mb', 'cpu_cores', 'job_inputs']
+
+# Seconds between heartbeats (last_updated_time updates) of a waiting or running job
+HEARTBEAT_SECONDS = 10
+
+# Longest time a job waits for its memory and cpu budget to fit on the host
+ADMISSION_TIMEOUT_SECONDS = 3600
+
+# Background load (1 minute load average, in cores) tolerated on the cores left over by a job cpu budget,
+# it also covers the decaying load average left by the previous job
+CPU_LOAD_TOLERANCE = 1.5
+
+# Job error output of an allocation failing under its own address space limit (python and numpy)
+MEMORY_ERROR_MARKERS = (b'MemoryError', b'numpy.core._exceptions._ArrayMemoryError', b'Unable to allocate')
+
+# Last lines of job error output kept to tell memory budget failures apart
+ERROR_TAIL_LINES = 200
+
+def get_budget(job, budget_name):
+    """ Budget declared for the job in etl_jobs_logging, None when the job has no limit """
+    budget = job[budget_name]
+    return None if pd.isna(budget) else float(budget)
+
+def total_memory_mb():
+    """ Physical memory of the host """
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+def available_memory_mb():
+    """ Memory available for new processes on the host """
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 1024
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+def host_cpu_ids():
+    """ Cores the orchestrator may run jobs on """
+    return sorted(os.sched_getaffinity(0))
+
+def job_cpu_count(cpu_cores):
+    """ Whole cores a job with a cpu budget is pinned to """
+    return max(1, math.ceil(cpu_cores))
+
+def budget_fits(max_memory_mb, cpu_cores):
+    """ True when the host has the memory of the budget available and its load leaves the cores of the budget free.
+    Jobs run one at a time, so the host memory and load already account for everything else running """
+    if max_memory_mb is not None and available_memory_mb() < max_memory_mb:
+        return False
+    if cpu_cores is not None and os.getloadavg()[0] > len(host_cpu_ids()) - job_cpu_count(cpu_cores) + CPU_LOAD_TOLERANCE:
+        return False
+    return True
+
+def job_cpu_ids(cpu_cores):
+    """ Cores a job with a cpu budget is pinned to, None without cpu budget """
+    return None if cpu_cores is None else set(host_cpu_ids()[:job_cpu_count(cpu_cores)])
+
+def update_job_status(cursor, job, job_run_id, status, error_message=None, end_time=None):
+    """ Updates the job run status, last_updated_time doubles as heartbeat of the run """
+    update_job_values = [status, error_message, end_time, str(datetime.now()), str(job['job_id']), job_run_id]
+    cursor.execute("UPDATE etl_jobs_execution_logging SET status = %s, error_message = %s, end_time = %s, last_updated_time = %s WHERE job_id = %s AND job_run_id = %s", update_job_values)
+
+def wait_for_budget(cursor, job, job_run_id):
+    """ Holds the job until its memory and cpu budget fits on the host, returns an error message if it never does """
+    max_memory_mb = get_budget(job, 'max_memory_mb')
+    cpu_cores = get_budget(job, 'cpu_cores')
+
+    if max_memory_mb is not None and max_memory_mb > total_memory_mb():
+        return f"{job['job_query']} memory budget of {max_memory_mb:.0f} MB exceeds host memory"
+    if cpu_cores is not None and job_cpu_count(cpu_cores) > len(host_cpu_ids()):
+        return f"{job['job_query']} cpu budget of {cpu_cores:g} cores exceeds host cores"
+
+    waiting_since = time.monotonic()
+    while not budget_fits(max_memory_mb, cpu_cores):
+        if time.monotonic() - waiting_since > ADMISSION_TIMEOUT_SECONDS:
+            return f"{job['job_query']} budget did not fit on host within {ADMISSION_TIMEOUT_SECONDS} seconds"
+        update_job_status(cursor, job, job_run_id, 'Waiting')
+        time.sleep(HEARTBEAT_SECONDS)
+
+    return None
+
+def job_resource_limits(job, cpu_ids):
+    """ Returns a function applying the job budget in the job process: an address space limit for its memory
+    budget and pinning to cpu_ids for its cpu budget, so it can never use more cores than that """
+    max_memory_mb = get_budget(job, 'max_memory_mb')
+
+    def apply_resource_limits():
+        if max_memory_mb is not None:
+            max_memory_bytes = int(max_memory_mb * 1024 ** 2)
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+        if cpu_ids is not None:
+            os.sched_setaffinity(0, cpu_ids)
+
+    return apply_resource_limits
+
+def tee_error_output(error_pipe, error_tail):
+    """ Copies job error output to the orchestrator error output as it is written, keeping its last lines """
+    for line in iter(error_pipe.readline, b''):
+        sys.stderr.buffer.write(line)
+        sys.stderr.flush()
+        error_tail.append(line)
+    error_pipe.close()
+
+def job_error_message(job, exit_code, error_output):
+    """ Error message of a failed job, failures caused by its memory budget are reported as such """
+    max_memory_mb = get_budget(job, 'max_memory_mb')
+
+    # The address space limit makes allocations fail inside the job, other kills and memory errors keep the exit code
+    if max_memory_mb is not None and any(marker in error_output for marker in MEMORY_ERROR_MARKERS):
+        return f"{job['job_query']} failed after exceeding its memory budget of {max_memory_mb:.0f} MB"
+
+    return f"{job['job_query']} failed with exit code {exit_code}"
+
+def fingerprint_input(job_input):
+    """ Fingerprint of one declared job input (kind:name) """
+    input_kind, input_name = job_input.strip().split(':', 1)
+
+    # File size and modification time
+    if input_kind == 'file':
+        file_stat = os.stat(input_name)
+        return f"{file_stat.st_size}-{file_stat.st_mtime_ns}"
+
+    # File content hash
+    if input_kind == 'file_hash':
+        file_hash = hashlib.sha256()
+        with open(input_name, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1024 * 1024), b''):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    # Table row count plus max id, or table content hash, of a table given as database.schema.table.
+    # The content hash sums row hashes, so it needs no sort and is independent of the row order
+    if input_kind in ('table', 'table_hash'):
+        database_name, schema_name, table_name = input_name.split('.')
+        table = sql.Identifier(schema_name, table_name)
+        if input_kind == 'table':
+            query = sql.SQL("SELECT COUNT(*) || '-' || COALESCE(MAX(id)::text, '') FROM {}").format(table)
+        else:
+            query = sql.SQL("SELECT COUNT(*) || '-' || COALESCE(SUM(hashtextextended(t::text, 0)), 0) FROM {} t").format(table)
+
+        connection = psycopg2.connect(host=DB_HOST, dbname=database_name, user=DB_USER, password=DB_PASS, port=DB_PORT)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query)
+            return cursor.fetchone()[0]
+        finally:
+            connection.close()
+
+    raise ValueError(f"Unknown job input kind {input_kind} in {job_input}")
+
+def fingerprint_job_inputs(job):
+    """ Fingerprint of the job command and all inputs declared for the job, None when the job declares no inputs """
+    if pd.isna(job['job_inputs']) or not job['job_inputs'].strip():
+        return None
+    # The command line is part of the fingerprint, so a job whose options changed runs again
+    return ';'.join([f"job_query={job['job_query']}"] + [f"{job_input.strip()}={fingerprint_input(job_input)}" for job_input in job['job_inputs'].split(';')])
+
+def last_succeeded_fingerprint(cursor, job):
+    """ Input fingerprint of the last successful run of the job """
+    cursor.execute("SELECT input_fingerprint FROM etl_jobs_execution_logging WHERE job_id = %s AND status = 'Succeeded' ORDER BY start_time DESC LIMIT 1", [str(job['job_id'])])
+    last_succeeded_run = cursor.fetchone()
+    return None if last_succeeded_run is None else last_succeeded_run[0]
+
+def run_etl_job(cursor, job, job_run_id):
+    """ Runs the job within its budget and timeout, returns True if the job succeeded or was skipped """
+    # Skip the job when its inputs did not change since its last successful run
+    try:
+        input_fingerprint = fingerprint_job_inputs(job)
+    except (Exception, psycopg2.DatabaseError) as error:
+        logging.error(' '+ str(datetime.now()) + ' ' + f"{job['job_query']} inputs could not be fingerprinted: {error}")
+        input_fingerprint = None
+
+    if input_fingerprint is not None:
+        skip_job = input_fingerprint == last_succeeded_fingerprint(cursor, job)
+        cursor.execute("UPDATE etl_jobs_execution_logging SET input_fingerprint = %s WHERE job_id = %s AND job_run_id = %s", [input_fingerprint, str(job['job_id']), job_run_id])
+        if skip_job:
+            print(f"{job['job_query']} skipped, inputs unchanged since last successful run")
+            update_job_status(cursor, job, job_run_id, 'Skipped', end_time=str(datetime.now()))
+            return True
+
+    error_message = wait_for_budget(cursor, job, job_run_id)
+    if error_message is not None:
+        update_job_status(cursor, job, job_run_id, 'Failed', error_message)
+        return False
+
+    update_job_status(cursor, job, job_run_id, 'Running')
+
+    # Let the job checkpoint its progress against this run
+    os.environ['ETL_JOB_ID'] = str(job['job_id'])
+    os.environ['ETL_JOB_RUN_ID'] = job_run_id
+
+    print(job['job_query'])
+    # Own process group so that the job and everything it started can be killed together
+    process = subprocess.Popen(job['job_query'], shell=True, start_new_session=True, stderr=subprocess.PIPE, preexec_fn=job_resource_limits(job, job_cpu_ids(get_budget(job, 'cpu_cores'))))
+    error_tail = deque(maxlen=ERROR_TAIL_LINES)
+    error_tee = threading.Thread(target=tee_error_output, args=(process.stderr, error_tail), daemon=True)
+    error_tee.start()
+
+    timeout_seconds = get_budget(job, 'timeout_seconds')
+    started = time.monotonic()
+    timed_out = False
+    while True:
+        try:
+            r = process.wait(timeout=HEARTBEAT_SECONDS)
+            break
+        except subprocess.TimeoutExpired:
+            if timeout_seconds is not None and time.monotonic() - started > timeout_seconds:
+                os.killpg(process.pid, signal.SIGKILL)
+                r = process.wait()
+                timed_out = True
+                break
+            update_job_status(cursor, job, job_run_id, 'Running')
+
+    error_tee.join(HEARTBEAT_SECONDS)
+    error_output = b''.join(error_tail)
+
+    if timed_out:
+        update_job_status(cursor, job, job_run_id, 'Failed', f"{job['job_query']} killed after timeout of {timeout_seconds:.0f} seconds")
+        return False
+
+    if r == 0:
+        update_job_status(cursor, job, job_run_id, 'Succeeded', end_time=str(datetime.now()))
+        return True
+
+    update_job_status(cursor, job, job_run_id, 'Failed', job_error_message(job, r, error_output))
+    return False
+
 def new_etl_job_run(conn):
     connection = psycopg2.connect(**conn)
     connection.autocommit = True
@@ -45,28 +282,20 @@ def new_etl_job_run(conn):
     cursor.execute(get_active_etl_jobs)
     active_jobs = cursor.fetchall()
 
-    active_jobs = pd.DataFrame(active_jobs, columns=['job_id', 'job_name', 'job_query', 'active_flag'])
+    active_jobs = pd.DataFrame(active_jobs, columns=JOB_COLUMNS)
 
     for i in range(len(active_jobs)):
         job_run_id = str(uuid.uuid1()).replace('-', '')
         start_job_values = [str(active_jobs.iloc[i]['job_id']), job_run_id, str(datetime.now()), str(datetime.now())]
 
         try:
-            cursor.execute("INSERT INTO etl_jobs_execution_logging values (%s, %s, %s, NULL, 'Running', NULL, %s)", start_job_values)
-            print(active_jobs.iloc[i]['job_query'])
-            r = os.system(active_jobs.iloc[i]['job_query'])
+            cursor.execute("INSERT INTO etl_jobs_execution_logging values (%s, %s, %s, NULL, 'Queued', NULL, %s)", start_job_values)
 
-            if r == 1:
-                update_job_values = [f"{active_jobs.iloc[i]['job_query']} failed", str(datetime.now()), str(active_jobs.iloc[i]['job_id']), job_run_id]
-                cursor.execute("UPDATE etl_jobs_execution_logging SET status = 'Failed', error_message = %s , last_updated_time = %s WHERE job_id = %s AND job_run_id = %s", update_job_values)
+            if not run_etl_job(cursor, active_jobs.iloc[i], job_run_id):
                 break
 
-            elif r == 0:
-                update_job_values = [str(datetime.now()), str(datetime.now()), str(active_jobs.iloc[i]['job_id']), job_run_id]
-                cursor.execute("UPDATE etl_jobs_execution_logging SET end_time = %s, status = 'Succeeded', last_updated_time = %s WHERE job_id = %s AND job_run_id = %s", update_job_values)
-
         except (Exception, psycopg2.DatabaseError) as error:
-            logging.error(' '+ str(datetime.now()) + ' ' + error)
+            logging.error(' '+ str(datetime.now()) + ' ' + str(error))
             print(error)
 
 
@@ -94,7 +323,7 @@ def restart_etl_jobs(conn):
 
     rest_etl_jobs_query = f""" SELECT * FROM etl_jobs_logging WHERE active_flag = 'Y' AND job_id >= {failed_jobs[0][0]}"""
     cursor.execute(rest_etl_jobs_query)
-    rest_etl_jobs = pd.DataFrame(cursor.fetchall(), columns=['job_id', 'job_name', 'job_query', 'active_flag'])
+    rest_etl_jobs = pd.DataFrame(cursor.fetchall(), columns=JOB_COLUMNS)
 
 
     for i in range(len(rest_etl_jobs)):
@@ -106,25 +335,15 @@ def restart_etl_jobs(conn):
 
         try:
             if rest_etl_jobs.iloc[i]['job_id'] == failed_jobs[0][0]:
-                update_job_values = [str(datetime.now()), str(datetime.now()), str(rest_etl_jobs.iloc[i]['job_id']), job_run_id]
-                cursor.execute("UPDATE etl_jobs_execution_logging SET end_time = %s, status = 'Restarted', error_message = NULL , last_updated_time = %s WHERE job_id = %s AND job_run_id = %s", update_job_values)
+                update_job_status(cursor, rest_etl_jobs.iloc[i], job_run_id, 'Restarted', end_time=str(datetime.now()))
             else:
-                cursor.execute("INSERT INTO etl_jobs_execution_logging values (%s, %s, %s, NULL, 'Running', NULL, %s)", start_job_values)
-
-            print(rest_etl_jobs.iloc[i]['job_query'])
-            r = os.system(rest_etl_jobs.iloc[i]['job_query'])
+                cursor.execute("INSERT INTO etl_jobs_execution_logging values (%s, %s, %s, NULL, 'Queued', NULL, %s)", start_job_values)
 
-            if r == 1:
-                update_job_values = [f"{rest_etl_jobs.iloc[i]['job_query']} failed", str(datetime.now()), str(rest_etl_jobs.iloc[i]['job_id']), job_run_id]
-                cursor.execute("UPDATE etl_jobs_execution_logging SET status = 'Failed', error_message = %s , last_updated_time = %s WHERE job_id = %s AND job_run_id = %s", update_job_values)
+            if not run_etl_job(cursor, rest_etl_jobs.iloc[i], job_run_id):
                 break
 
-            elif r == 0:
-                update_job_values = [str(datetime.now()), str(datetime.now()), str(rest_etl_jobs.iloc[i]['job_id']), job_run_id]
-                cursor.execute("UPDATE etl_jobs_execution_logging SET end_time = %s, status = 'Succeeded', last_updated_time = %s WHERE job_id = %s AND job_run_id = %s", update_job_values)
-
         except (Exception, psycopg2.DatabaseError) as error:
-            logging.error(' '+ str(datetime.now()) + ' ' + error)
+            logging.error(' '+ str(datetime.now()) + ' ' + str(error))
             print(error)
 
 
@@ -147,4 +366,4 @@ def main(run_type):
         restart_etl_jobs(conn)
 
 if __name__ == "__main__":
-    main(opt["--run_type"])
\ No newline at end of file
+    main(opt["--run_type"])
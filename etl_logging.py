@@ -69,7 +69,11 @@ def create_logging_tables(engine):
             job_id INTEGER NOT NULL,
             job_name VARCHAR(50) NOT NULL,
             job_query VARCHAR(255) NOT NULL,
-            active_flag CHAR(1)      
+            active_flag CHAR(1),
+            timeout_seconds INTEGER,
+            max_memory_mb INTEGER,
+            cpu_cores REAL,
+            job_inputs VARCHAR(1000)
         )
         """,
         """ 
@@ -81,7 +85,30 @@ def create_logging_tables(engine):
                 end_time TIMESTAMP, 
                 status VARCHAR(20),
                 error_message TEXT,
-                last_updated_time TIMESTAMP
+                last_updated_time TIMESTAMP,
+                input_fingerprint TEXT
+                )
+        """,
+        """
+        DROP TABLE IF EXISTS dbo.etl_jobs_checkpoint CASCADE;
+        CREATE TABLE IF NOT EXISTS dbo.etl_jobs_checkpoint (
+                job_id INTEGER NOT NULL,
+                job_run_id VARCHAR(255) NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                source_offset BIGINT NOT NULL,
+                last_updated_time TIMESTAMP,
+                PRIMARY KEY (job_id, job_run_id)
+                )
+        """,
+        """
+        DROP TABLE IF EXISTS dbo.etl_report_plans CASCADE;
+        CREATE TABLE IF NOT EXISTS dbo.etl_report_plans (
+                job_run_id VARCHAR(255),
+                view_name VARCHAR(128) NOT NULL,
+                total_cost DOUBLE PRECISION NOT NULL,
+                plan_regressed BOOLEAN NOT NULL,
+                query_plan JSONB NOT NULL,
+                captured_time TIMESTAMP NOT NULL
                 )
         """
         )
@@ -113,7 +140,7 @@ def main():
     f"postgresql://{DB_USER}:%s@{DB_HOST}:{DB_PORT}/{database_name}" % urllib.parse.quote(DB_PASS))
 
     create_logging_tables(engine)
-    logging.info(' '+ str(datetime.now()) + ' ' + 'dbo.etl_jobs_logging, dbo.etl_jobs_execution_logging in target database created successfully\n')
+    logging.info(' '+ str(datetime.now()) + ' ' + 'dbo.etl_jobs_logging, dbo.etl_jobs_execution_logging, dbo.etl_jobs_checkpoint, dbo.etl_report_plans in target database created successfully\n')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
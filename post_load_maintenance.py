@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Post load maintenance of target datawarehouse: index builds, statistics and report view plans"""
+
+import os
+import json
+import logging
+import pandas as pd
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlalchemy import text
+from warehouse_backends import create_warehouse_engine
+
+# Load environment file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(filename='jobs_logging.log', level=logging.DEBUG)
+
+# Set by etl_job_run.py for every job it runs
+ETL_JOB_RUN_ID = os.environ.get("ETL_JOB_RUN_ID")
+
+# Report views whose plans are captured after every load
+REPORT_VIEWS = ['vw_top5_driver_login_device', 'vw_working_driver_expirylicense', 'vw_percentage_canceled_rides']
+
+# A plan whose estimated total cost grew by more than this factor since the last capture is flagged as regressed
+PLAN_REGRESSION_FACTOR = 2
+
+# Prefix of the index names of the spec, indexes with it that are no longer in the spec are dropped
+INDEX_PREFIX = 'ix_'
+
+
+def read_index_spec():
+    """ Declarative index spec per table from references/table_indexes.csv """
+    index_spec = pd.read_csv('./references/table_indexes.csv')
+    index_spec['index_predicate'] = index_spec['index_predicate'].where(index_spec['index_predicate'].notna(), None)
+    return index_spec
+
+
+def relation_exists(conn, relation_name):
+    """ True if the table or view exists in the dbo schema """
+    return conn.execute(text("SELECT to_regclass(:relation_name)"), {"relation_name": f"dbo.{relation_name}"}).scalar() is not None
+
+
+def drop_unlisted_indexes(engine, index_spec):
+    """ Drop indexes built from an earlier spec, they would otherwise be kept up to date on every load for nothing """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        result = conn.execute(text("SELECT indexname FROM pg_indexes WHERE schemaname = 'dbo' AND starts_with(indexname, :index_prefix)"), {"index_prefix": INDEX_PREFIX})
+        for index_name in [row[0] for row in result.fetchall()]:
+            if index_name not in set(index_spec['index_name']):
+                conn.execute(f"DROP INDEX IF EXISTS dbo.{index_name}")
+                logging.info(' '+ str(datetime.now()) + ' ' + f"index dbo.{index_name} not in spec dropped")
+
+def build_indexes(engine, index_spec):
+    """ Build the indexes of the spec missing on the loaded tables, concurrently where the spec allows it """
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for index in index_spec.itertuples(index=False):
+            if not relation_exists(conn, index.table_name):
+                continue
+
+            # A failed concurrent build leaves an invalid index behind that has to be built again
+            result = conn.execute(text("SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(:index_name)"), {"index_name": f"dbo.{index.index_name}"})
+            index_valid = result.scalar()
+            if index_valid is False:
+                conn.execute(f"DROP INDEX IF EXISTS dbo.{index.index_name}")
+
+            concurrently = 'CONCURRENTLY' if index.concurrently == 'Y' else ''
+            predicate = f"WHERE {index.index_predicate}" if index.index_predicate is not None else ''
+            conn.execute(f"CREATE INDEX {concurrently} IF NOT EXISTS {index.index_name} ON dbo.{index.table_name} ({index.index_columns}) {predicate}")
+            logging.info(' '+ str(datetime.now()) + ' ' + f"index dbo.{index.index_name} on dbo.{index.table_name} built")
+
+
+def report_view_tables(conn):
+    """ Tables the report views read from """
+    result = conn.execute(text("SELECT DISTINCT table_name FROM information_schema.view_table_usage WHERE view_schema = 'dbo' AND table_schema = 'dbo' AND view_name = ANY(:view_names)"), {"view_names": REPORT_VIEWS})
+    return [row[0] for row in result.fetchall()]
+
+def analyze_tables(engine, index_spec):
+    """ Refresh planner statistics of the indexed tables and the tables the report views read from """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table_name in sorted(set(index_spec['table_name']) | set(report_view_tables(conn))):
+            if relation_exists(conn, table_name):
+                conn.execute(f"ANALYZE dbo.{table_name}")
+
+
+def capture_report_plans(engine):
+    """ Record EXPLAIN plans of the report views with this job run and flag plans whose cost regressed """
+    with engine.begin() as conn:
+        for view_name in REPORT_VIEWS:
+            if not relation_exists(conn, view_name):
+                continue
+
+            plan = conn.execute(f"EXPLAIN (FORMAT JSON) SELECT * FROM dbo.{view_name}").scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            total_cost = plan[0]['Plan']['Total Cost']
+
+            result = conn.execute(text("SELECT total_cost FROM dbo.etl_report_plans WHERE view_name = :view_name ORDER BY captured_time DESC LIMIT 1"), {"view_name": view_name})
+            last_total_cost = result.scalar()
+            plan_regressed = last_total_cost is not None and total_cost > last_total_cost * PLAN_REGRESSION_FACTOR
+            if plan_regressed:
+                print(f"Plan of dbo.{view_name} regressed: estimated cost {last_total_cost} -> {total_cost}")
+                logging.warning(' '+ str(datetime.now()) + ' ' + f"plan of dbo.{view_name} regressed: estimated cost {last_total_cost} -> {total_cost}")
+
+            conn.execute(text("""
+                INSERT INTO dbo.etl_report_plans (job_run_id, view_name, total_cost, plan_regressed, query_plan, captured_time)
+                VALUES (:job_run_id, :view_name, :total_cost, :plan_regressed, :query_plan, :captured_time)
+                """), {"job_run_id": ETL_JOB_RUN_ID, "view_name": view_name, "total_cost": total_cost, "plan_regressed": plan_regressed, "query_plan": json.dumps(plan), "captured_time": datetime.now()})
+
+
+def main():
+    # target database
+    database_name = 'target'
+
+    engine = create_warehouse_engine(database_name)
+
+    # Embedded columnar warehouses keep their own min/max zone maps and statistics, indexes and plans are PostgreSQL only
+    if engine.dialect.name != 'postgresql':
+        print(f"Post load maintenance skipped on {engine.dialect.name} warehouse")
+        return
+
+    index_spec = read_index_spec()
+    drop_unlisted_indexes(engine, index_spec)
+    build_indexes(engine, index_spec)
+    analyze_tables(engine, index_spec)
+    capture_report_plans(engine)
+
+if __name__ == "__main__":
+    main()
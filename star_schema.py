@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Star schema (dimensions with integer surrogate keys and narrow fact tables) in target datawarehouse"""
+
+import pandas as pd
+from sqlalchemy import text, table, column
+from sqlalchemy.dialects.postgresql import insert
+from warehouse_backends import surrogate_key_column
+
+# Dimension table, surrogate key column and natural key column of every dimension
+DIMENSIONS = {
+    'device': ('dim_device', 'device_key', 'client_device'),
+    'country': ('dim_country', 'country_key', 'country'),
+    'driver': ('dim_driver', 'driver_key', 'driver_id'),
+    'date': ('dim_date', 'date_key', 'calendar_date')
+}
+
+# Driver attributes kept in dim_driver
+DRIVER_ATTRIBUTES = ['first_name', 'last_name', 'driver_license_number', 'expiry_date', 'working']
+
+
+def create_star_schema(conn):
+    """ Create dimension and fact tables if they do not exist yet """
+    commands = (
+        f"""
+        CREATE TABLE IF NOT EXISTS dbo.dim_device (
+            {surrogate_key_column(conn, 'dim_device', 'device_key')},
+            client_device VARCHAR(50) NOT NULL UNIQUE
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS dbo.dim_country (
+            {surrogate_key_column(conn, 'dim_country', 'country_key')},
+            country VARCHAR(70) NOT NULL UNIQUE
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS dbo.dim_driver (
+            {surrogate_key_column(conn, 'dim_driver', 'driver_key')},
+            driver_id INTEGER NOT NULL UNIQUE,
+            first_name VARCHAR(128),
+            last_name VARCHAR(128),
+            driver_license_number VARCHAR(128),
+            expiry_date DATE,
+            working BOOLEAN
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS dbo.dim_date (
+            {surrogate_key_column(conn, 'dim_date', 'date_key')},
+            calendar_date DATE NOT NULL UNIQUE,
+            year SMALLINT NOT NULL,
+            month SMALLINT NOT NULL,
+            day SMALLINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS dbo.fact_driver_login (
+            login_time TIMESTAMPTZ NOT NULL,
+            date_key INTEGER NOT NULL,
+            driver_key INTEGER,
+            device_key INTEGER NOT NULL,
+            country_key INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS dbo.fact_cab_ride (
+            cab_ride_id INTEGER PRIMARY KEY,
+            date_key INTEGER NOT NULL,
+            shift_id INTEGER NOT NULL,
+            payment_type_id INTEGER NOT NULL,
+            canceled BOOLEAN,
+            price DECIMAL(10, 2) NOT NULL
+        )
+        """
+    )
+
+    for command in commands:
+        conn.execute(command)
+
+
+def warm_key_caches(conn):
+    """ In-memory natural key to surrogate key lookups of every dimension, pre-warmed from the dimension tables """
+    key_caches = {}
+    for dimension, (table_name, key_column, natural_key_column) in DIMENSIONS.items():
+        result = conn.execute(f"SELECT {natural_key_column}, {key_column} FROM dbo.{table_name}")
+        key_caches[dimension] = dict(result.fetchall())
+
+    return key_caches
+
+
+def dimension_members(dimension, natural_keys):
+    """ Rows of new dimension members, date members get their calendar attributes """
+    if dimension == 'date':
+        return [{'calendar_date': calendar_date, 'year': calendar_date.year, 'month': calendar_date.month, 'day': calendar_date.day} for calendar_date in natural_keys]
+
+    natural_key_column = DIMENSIONS[dimension][2]
+    return [{natural_key_column: natural_key} for natural_key in natural_keys]
+
+
+def cache_dimension_keys(conn, key_caches, dimension, natural_keys):
+    """ Look surrogate keys of natural_keys up in the dimension table and add them to the cache """
+    table_name, key_column, natural_key_column = DIMENSIONS[dimension]
+    result = conn.execute(text(f"SELECT {natural_key_column}, {key_column} FROM dbo.{table_name} WHERE {natural_key_column} = ANY(:natural_keys)"), {"natural_keys": list(natural_keys)})
+    key_caches[dimension].update(result.fetchall())
+
+
+def resolve_keys(conn, key_caches, dimension, natural_keys):
+    """ Surrogate keys for a series of natural keys, members missing from the cache are inserted in bulk """
+    table_name, key_column, natural_key_column = DIMENSIONS[dimension]
+    key_cache = key_caches[dimension]
+
+    # numpy scalars are turned into python values the database driver can adapt
+    distinct_keys = [natural_key.item() if hasattr(natural_key, 'item') else natural_key for natural_key in natural_keys.dropna().drop_duplicates().tolist()]
+    missing_keys = [natural_key for natural_key in distinct_keys if natural_key not in key_cache]
+    if missing_keys:
+        members = dimension_members(dimension, missing_keys)
+        dimension_table = table(table_name, *[column(column_name) for column_name in members[0]], schema='dbo')
+
+        # Members inserted meanwhile by another load are left as they are and picked up by the lookup
+        conn.execute(insert(dimension_table).on_conflict_do_nothing(index_elements=[natural_key_column]), members)
+        cache_dimension_keys(conn, key_caches, dimension, missing_keys)
+
+    return natural_keys.map(key_cache).astype('Int64')
+
+
+def upsert_drivers(conn, key_caches, driver_details):
+    """ Insert new drivers into dim_driver and update the attributes of known drivers """
+    drivers = driver_details.rename(columns={'id': 'driver_id'})[['driver_id'] + DRIVER_ATTRIBUTES]
+    members = drivers.astype(object).where(drivers.notna(), None).to_dict('records')
+    if not members:
+        return
+
+    driver_table = table('dim_driver', *[column(column_name) for column_name in ['driver_id'] + DRIVER_ATTRIBUTES], schema='dbo')
+    statement = insert(driver_table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['driver_id'],
+        set_={attribute: statement.excluded[attribute] for attribute in DRIVER_ATTRIBUTES}
+    )
+    conn.execute(statement, members)
+    cache_dimension_keys(conn, key_caches, 'driver', drivers['driver_id'].tolist())
+
+
+def build_login_facts(conn, key_caches, transformed_weblogs):
+    """ Driver login facts of a chunk of transformed weblogs, dimension attributes replaced by surrogate keys """
+    return pd.DataFrame({
+        'login_time': transformed_weblogs['login_time'],
+        'date_key': resolve_keys(conn, key_caches, 'date', transformed_weblogs['login_time'].dt.date),
+        'driver_key': resolve_keys(conn, key_caches, 'driver', pd.to_numeric(transformed_weblogs['user_name'], errors='coerce').astype('Int64')),
+        'device_key': resolve_keys(conn, key_caches, 'device', transformed_weblogs['client_device']),
+        'country_key': resolve_keys(conn, key_caches, 'country', transformed_weblogs['country'])
+    })
+
+
+def build_cab_ride_facts(conn, key_caches, cabride_details):
+    """ Cab ride facts, ride start date replaced by its surrogate key """
+    return pd.DataFrame({
+        'cab_ride_id': cabride_details['id'],
+        'date_key': resolve_keys(conn, key_caches, 'date', pd.to_datetime(cabride_details['ride_start_time']).dt.date),
+        'shift_id': cabride_details['shift_id'],
+        'payment_type_id': cabride_details['payment_type_id'],
+        'canceled': cabride_details['canceled'],
+        'price': cabride_details['price']
+    })
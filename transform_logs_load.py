@@ -3,47 +3,154 @@
 # Author: Karanpreet Kaur
 # date: 2022-09-05
 
-"""Transform and Load weblogs data"""
+"""Transform and Load weblogs data
+
+Usage: transform_logs_load.py [--archive_before =<archive_before>] [--aggregate_only] [--no_dedup] [--dedup_capacity =<dedup_capacity>] [--dedup_error_rate =<dedup_error_rate>]
+
+Options:
+--aggregate_only                        (Optional argument) Load only login counts into the summary tables, not the raw weblog rows
+--no_dedup                              (Optional argument) Load every log line without checking it against the lines loaded before
+--dedup_capacity =<dedup_capacity>      (Optional argument) Number of distinct log lines the duplicate line filter is sized for [default: 10000000]
+--dedup_error_rate =<dedup_error_rate>  (Optional argument) False positive rate of the duplicate line filter at its capacity [default: 0.001]
+--archive_before =<archive_before>  (Optional argument) Detach weblog partitions of login months before this month (YYYY-MM) into the archive schema after the load
+"""
+import calendar
+import io
+import itertools
+import re
+import numpy as np
 import pandas as pd
 import psycopg2
-import os
 from dotenv import load_dotenv
-import urllib.parse
-from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from docopt import docopt
+from etl_checkpoint import get_last_checkpoint, save_checkpoint
+from star_schema import create_star_schema, warm_key_caches, build_login_facts
+from warehouse_backends import create_warehouse_engine, supports_partitions, bulk_insert_method
+from weblogs_dedup import DEDUP_CAPACITY, DEDUP_ERROR_RATE, DEDUP_SINKS, create_dedup_tables, load_dedup_filter, save_dedup_filter, hash_weblog_lines, find_new_lines, bloom_add
 
 # Load environment file
 load_dotenv()
 
-# Read connection details
-DB_HOST = os.environ.get("DB_HOST")
-DB_PASS = os.environ.get("DB_PASS")
-DB_NAME = os.environ.get("DB_NAME")
-DB_USER = os.environ.get("DB_USER")
-DB_PORT = os.environ.get("DB_PORT")
+# Number of log lines parsed and committed together
+WEBLOGS_CHUNKSIZE = 100000
 
-def transform_weblogs():
-    """ Transformation of weblogs for reporting """
+# Fields of a log line in combined log format
+WEBLOGS_FIELDS = ['ip_address', 'identity_of_client', 'user_name', 'timestamp', 'timezone', 'http_request', 'http_status_code', 'bytes_transferred', 'referer', 'user_agent']
 
-    # Read weblogs data 
-    weblogs_data = pd.read_csv('weblogs.log', sep=" ", header=None)
-    weblogs_data.columns = ['ip_address', 'identity_of_client', 'user_name', 'timestamp', 'timezone', 'http_request', 'http_status_code', 'bytes_transferred', 'referer', 'user_agent']
+# Fields the transformation needs, the other fields are skipped by the parser
+WEBLOGS_COLUMNS = ['ip_address', 'user_name', 'timestamp', 'timezone', 'user_agent']
 
-    # Select relevant columns required for reporting
-    relevant_columns = ['ip_address', 'user_name', 'timestamp', 'timezone', 'user_agent']
-    weblogs_data = weblogs_data[relevant_columns]
+# Month numbers keyed by the first three letters of the month name (full %B or abbreviated %b names)
+MONTH_NUMBERS = {calendar.month_abbr[month]: month for month in range(1, 13)}
+MONTH_KEYS = np.array(sorted((ord(name[0]) << 16) | (ord(name[1]) << 8) | ord(name[2]) for name in MONTH_NUMBERS))
+MONTH_KEY_NUMBERS = np.array([MONTH_NUMBERS[chr(key >> 16) + chr((key >> 8) & 0xff) + chr(key & 0xff)] for key in MONTH_KEYS])
 
-    # Do transformation of timestamp and refine timezone
-    weblogs_data['timestamp'] = weblogs_data['timestamp'] + ' ' + weblogs_data['timezone']
-    weblogs_data['timezone'] = weblogs_data['timezone'].str.replace(']', '')
-    weblogs_data['timezone'] =  'UTC '+ (weblogs_data['timezone'].str.slice(0, 3) + ':' + weblogs_data['timezone'].str.slice(3, 6))
-    weblogs_data['timezone'] =  weblogs_data['timezone'].replace('UTC +00:00', 'UTC').replace('UTC -00:00', 'UTC')
+def read_country_timezone_mapping():
+    """ Country per utc offset used to map countries for weblogs """
 
     # Read country time zone mapping to map countries for weblogs
     country_timezone_mapping = pd.read_csv('./references/country_time_zone.csv')
     country_timezone_mapping.columns = ['country', 'city', 'utc_offset']
 
-    # Sampling one country per utc offset
-    country_timezone_mapping = country_timezone_mapping.groupby('utc_offset').apply(lambda x: x.sample(1)).reset_index(drop=True)
+    # Sampling one country per utc offset, seeded so that resumed runs map countries the same way
+    country_timezone_mapping = country_timezone_mapping.groupby('utc_offset').apply(lambda x: x.sample(1, random_state=0)).reset_index(drop=True)
+
+    return country_timezone_mapping
+
+def as_code_points(strings):
+    """ Characters of strings as a (rows, width) array of code points, shorter strings are padded with 0 """
+    strings = np.asarray(strings, dtype=str)
+    return strings.view(np.uint32).reshape(len(strings), -1), np.char.str_len(strings)
+
+def parse_digits(code_points, positions, n_digits, field_name):
+    """ Integer made of n_digits decimal digits starting at positions (one per row), raises if any of them is not a digit """
+    if ((positions < 0) | (positions + n_digits > code_points.shape[1])).any():
+        raise ValueError(f"weblogs contain timestamps too short for their {field_name}")
+
+    rows = np.arange(len(code_points))
+    number = np.zeros(len(code_points), dtype=np.int64)
+    for digit in range(n_digits):
+        digits = code_points[rows, positions + digit].astype(np.int64) - ord('0')
+        if ((digits < 0) | (digits > 9)).any():
+            raise ValueError(f"weblogs contain timestamps with non digit characters in their {field_name}")
+        number = number * 10 + digits
+    return number
+
+def parse_weblog_timestamps(timestamp, timezone):
+    """ Parse '[dd/Month/yyyy:HH:MM:SS' and '+hhmm]' log fields into UTC datetimes.
+
+    The fields have a fixed layout apart from the month name, so every part is read at
+    fixed positions from the start or the end of the string and the month is looked up
+    by its first three letters, without a per row strptime.
+    """
+    if len(timestamp) == 0:
+        return pd.Series(pd.to_datetime([], utc=True), index=timestamp.index)
+
+    code_points, lengths = as_code_points(timestamp)
+    rows = np.arange(len(code_points))
+
+    # '[dd/' from the start and 'yyyy:HH:MM:SS' from the end
+    day = parse_digits(code_points, np.full(len(code_points), 1), 2, 'day')
+    year = parse_digits(code_points, lengths - 13, 4, 'year')
+    hour = parse_digits(code_points, lengths - 8, 2, 'hour')
+    minute = parse_digits(code_points, lengths - 5, 2, 'minute')
+    second = parse_digits(code_points, lengths - 2, 2, 'second')
+
+    month_keys = (code_points[rows, 4].astype(np.int64) << 16) | (code_points[rows, 5].astype(np.int64) << 8) | code_points[rows, 6]
+    month_index = np.searchsorted(MONTH_KEYS, month_keys).clip(0, len(MONTH_KEYS) - 1)
+    if not (MONTH_KEYS[month_index] == month_keys).all():
+        raise ValueError("weblogs contain timestamps with unknown month names")
+    month = MONTH_KEY_NUMBERS[month_index]
+
+    # '+hhmm]' utc offset, a missing offset becomes 'nan' and fails the sign check
+    offset_code_points, _ = as_code_points(timezone)
+    if not np.isin(offset_code_points[:, 0], [ord('+'), ord('-')]).all():
+        raise ValueError("weblogs contain utc offsets without a + or - sign")
+    offset_sign = np.where(offset_code_points[:, 0] == ord('-'), -1, 1)
+    offset_positions = np.full(len(offset_code_points), 1)
+    offset_seconds = offset_sign * (parse_digits(offset_code_points, offset_positions, 2, 'utc offset hours') * 3600 + parse_digits(offset_code_points, offset_positions + 2, 2, 'utc offset minutes') * 60)
+
+    # Local date and time of day, normalized to UTC by the offset
+    login_date = ((year - 1970).astype('datetime64[Y]') + (month - 1).astype('timedelta64[M]')).astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    login_time = login_date.astype('datetime64[s]') + (hour * 3600 + minute * 60 + second - offset_seconds).astype('timedelta64[s]')
+
+    return pd.Series(login_time, index=timestamp.index).dt.tz_localize('UTC')
+
+def read_weblog_lines(source_offset=0, chunksize=WEBLOGS_CHUNKSIZE):
+    """ Read raw weblog lines (bytes) in chunks, starting after the first source_offset lines """
+    with open('weblogs.log', 'rb') as weblogs_file:
+        for line in itertools.islice(weblogs_file, source_offset):
+            pass
+        while True:
+            weblog_lines = np.array([line.rstrip(b'\r\n') for line in itertools.islice(weblogs_file, chunksize)], dtype=object)
+            if len(weblog_lines) == 0:
+                break
+            yield weblog_lines
+
+def parse_weblog_lines(weblog_lines, usecols=WEBLOGS_COLUMNS):
+    """ Parse only the usecols fields of raw weblog lines, one row per line """
+    if len(weblog_lines) == 0:
+        return pd.DataFrame(columns=usecols, dtype=str)
+    weblogs_data = pd.read_csv(io.BytesIO(b'\n'.join(weblog_lines)), sep=" ", header=None, names=WEBLOGS_FIELDS, usecols=usecols, dtype=str)
+    if len(weblogs_data) != len(weblog_lines):
+        raise ValueError(f"{len(weblog_lines)} weblog lines parsed into {len(weblogs_data)} rows")
+    return weblogs_data
+
+def transform_weblogs(weblogs_data, country_timezone_mapping):
+    """ Transformation of a chunk of weblogs for reporting """
+
+    # Select relevant columns required for reporting
+    weblogs_data = weblogs_data[WEBLOGS_COLUMNS].copy()
+    weblogs_data['user_name'] = weblogs_data['user_name'].astype(str)
+
+    # Parse timestamp and its utc offset into UTC login time and refine timezone
+    weblogs_data['timestamp'] = parse_weblog_timestamps(weblogs_data['timestamp'], weblogs_data['timezone'])
+    weblogs_data.rename(columns={'timestamp': 'login_time'}, inplace=True)
+    weblogs_data['timezone'] = weblogs_data['timezone'].str.replace(']', '', regex=False)
+    weblogs_data['timezone'] =  'UTC '+ (weblogs_data['timezone'].str.slice(0, 3) + ':' + weblogs_data['timezone'].str.slice(3, 6))
+    weblogs_data['timezone'] =  weblogs_data['timezone'].replace('UTC +00:00', 'UTC').replace('UTC -00:00', 'UTC')
 
     # Get country name per user login based on timezone(utc offset)
     weblogs_country_data = weblogs_data.merge(country_timezone_mapping[['country', 'utc_offset']], left_on='timezone', right_on='utc_offset', how='left')
@@ -57,48 +164,208 @@ def transform_weblogs():
 
     return weblogs_country_data
 
-def load_logs_to_dw(transformed_weblogs, engine):
-    """Load transformed weblogs into target datawarehouse in dbo schema"""
-    command = (
+def aggregate_weblogs(transformed_weblogs):
+    """ Login counts per hour, user, client device and country of a chunk of transformed weblogs """
+    login_counts = transformed_weblogs.assign(login_hour=transformed_weblogs['login_time'].dt.floor('H'))
+    return login_counts.groupby(['login_hour', 'user_name', 'client_device', 'country']).size().rename('n_logins').reset_index()
+
+def aggregate_device_logins(user_login_counts):
+    """ Login counts per hour, client device and country rolled up from user login counts """
+    return user_login_counts.groupby(['login_hour', 'client_device', 'country'])['n_logins'].sum().reset_index()
+
+def upsert_counts(pd_table, conn, keys, data_iter):
+    """ to_sql method inserting count rows, adding the count to existing rows with the same key columns """
+    count_column = keys[-1]
+    statement = insert(pd_table.table).values([dict(zip(keys, row)) for row in data_iter])
+    statement = statement.on_conflict_do_update(
+        index_elements=keys[:-1],
+        set_={count_column: pd_table.table.c[count_column] + statement.excluded[count_column]}
+    )
+    conn.execute(statement)
+
+# Name of a monthly dbo.user_weblogs partition, see weblogs_partition_name
+WEBLOGS_PARTITION_PATTERN = re.compile(r'^user_weblogs_y(\d{4})m(\d{2})$')
+
+def weblogs_partition_name(login_month):
+    """ Name of the dbo.user_weblogs partition holding logins of the month """
+    return f"user_weblogs_y{login_month.year}m{login_month.month:02d}"
+
+def create_weblogs_partitions(conn, login_time):
+    """ Create the monthly partitions of dbo.user_weblogs the login times fall into, if missing """
+    login_months = login_time.dt.tz_convert('UTC').dt.tz_localize(None).dt.to_period('M').unique()
+    for login_month in login_months:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS dbo.{weblogs_partition_name(login_month)} PARTITION OF dbo.user_weblogs
+            FOR VALUES FROM ('{login_month.start_time:%Y-%m-%d} 00:00:00+00') TO ('{(login_month + 1).start_time:%Y-%m-%d} 00:00:00+00')
+            """)
+
+def archive_weblogs_partitions(engine, archive_before):
+    """ Detach partitions of login months before archive_before (YYYY-MM) and move them to the archive schema,
+    merging them into the archived table of the month when the month was archived before
+    """
+    if not supports_partitions(engine):
+        print(f"Archiving weblogs partitions is not supported on {engine.dialect.name} warehouse")
+        return
+
+    archive_before = pd.Period(archive_before, freq='M')
+    partitions_query = """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'dbo.user_weblogs'::regclass
         """
-        DROP TABLE IF EXISTS dbo.driver_weblogs CASCADE;
-        CREATE TABLE IF NOT EXISTS dbo.driver_weblogs (
+
+    with engine.begin() as conn:
+        conn.execute("CREATE SCHEMA IF NOT EXISTS archive")
+        partitions = [row[0] for row in conn.execute(partitions_query).fetchall()]
+        for partition in sorted(partitions):
+            # Only monthly partitions, a default or hand made partition is left attached
+            month_match = WEBLOGS_PARTITION_PATTERN.match(partition)
+            if month_match is None:
+                continue
+            login_month = pd.Period(year=int(month_match.group(1)), month=int(month_match.group(2)), freq='M')
+            if login_month < archive_before:
+                conn.execute(f"ALTER TABLE dbo.user_weblogs DETACH PARTITION dbo.{partition}")
+                archived = conn.execute(f"SELECT to_regclass('archive.{partition}') IS NOT NULL").scalar()
+                if archived:
+                    # Month archived before and loaded again since, its rows are added to the archived table
+                    conn.execute(f"INSERT INTO archive.{partition} SELECT * FROM dbo.{partition}")
+                    conn.execute(f"DROP TABLE dbo.{partition}")
+                else:
+                    conn.execute(f"ALTER TABLE dbo.{partition} SET SCHEMA archive")
+                print(f"Archived weblogs partition {partition}")
+
+        # Login counts of archived months are kept, the summary tables and report views cover the full history
+
+def load_logs_to_dw(engine, aggregate_only=False, dedup=True, dedup_capacity=DEDUP_CAPACITY, dedup_error_rate=DEDUP_ERROR_RATE):
+    """Load transformed weblogs into monthly partitions of dbo.user_weblogs, driver login facts and login counts into
+    summary tables in target datawarehouse, one committed chunk at a time. With aggregate_only only the login counts are loaded.
+    With dedup, log lines loaded before are dropped, using duplicate line filters sized by dedup_capacity and dedup_error_rate.
+    Raw rows and login counts are deduplicated separately, so lines of an aggregate only load are still loaded as raw rows later.
+    """
+    partitioned = supports_partitions(engine)
+    sinks = ['aggregate'] if aggregate_only else ['raw', 'aggregate']
+    command = (
+        f"""
+        CREATE TABLE IF NOT EXISTS dbo.user_weblogs (
             ip_address VARCHAR(50) NOT NULL,
             user_name VARCHAR(50) NOT NULL,
-            timestamp VARCHAR(255) NOT NULL,
+            login_time TIMESTAMPTZ NOT NULL,
             timezone VARCHAR(20) NOT NULL,
             country VARCHAR(70) NOT NULL,
             client_device CHAR(50) NOT NULL
+        ) {'PARTITION BY RANGE (login_time)' if partitioned else ''}
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS dbo.agg_driver_logins_hourly (
+            login_hour TIMESTAMPTZ NOT NULL,
+            client_device VARCHAR(50) NOT NULL,
+            country VARCHAR(70) NOT NULL,
+            n_logins BIGINT NOT NULL,
+            PRIMARY KEY (login_hour, client_device, country)
+        );
+        CREATE TABLE IF NOT EXISTS dbo.agg_user_logins_hourly (
+            login_hour TIMESTAMPTZ NOT NULL,
+            user_name VARCHAR(50) NOT NULL,
+            client_device VARCHAR(50) NOT NULL,
+            country VARCHAR(70) NOT NULL,
+            n_logins BIGINT NOT NULL,
+            PRIMARY KEY (login_hour, user_name, client_device, country)
         )
         """,
         """
-        CREATE OR REPLACE VIEW dbo.vw_top5_driver_login_device AS
+        DROP VIEW IF EXISTS dbo.vw_top5_driver_login_device;
+        CREATE VIEW dbo.vw_top5_driver_login_device AS
         SELECT 
             client_device AS driver_login_device_name, 
-	        COUNT(*) AS n_logins
-        FROM dbo.user_weblogs
+	        SUM(n_logins) AS n_logins
+        FROM dbo.agg_driver_logins_hourly
         GROUP BY 1
         ORDER BY 2 DESC
         LIMIT 5 
         """
     )
 
+    # Weblogs used to be loaded into a plain table replaced on every load, replace it once by the partitioned table
     with engine.begin() as conn:
+        if partitioned:
+            result = conn.execute(text("SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'dbo' AND c.relname = 'user_weblogs'"))
+            table_kind = result.scalar()
+            if table_kind is not None and table_kind != 'p':
+                conn.execute("DROP TABLE dbo.user_weblogs CASCADE")
         conn.execute(command[0])
-    transformed_weblogs.to_sql('user_weblogs', con=engine, if_exists='replace', index = False, schema='dbo')
+        conn.execute(command[1])
+        create_star_schema(conn)
+        key_caches = warm_key_caches(conn)
+        if dedup:
+            create_dedup_tables(conn)
+            bloom_filters = {sink: load_dedup_filter(conn, sink, dedup_capacity, dedup_error_rate) for sink in sinks}
+
+    # Resume after the last committed chunk when the job is restarted
+    checkpoint = get_last_checkpoint(engine)
+    if checkpoint is None:
+        chunk_index, source_offset = -1, 0
+    else:
+        chunk_index, source_offset = checkpoint
+        print(f"Resuming weblogs load after chunk {chunk_index} (line {source_offset})")
+
+    country_timezone_mapping = read_country_timezone_mapping()
+    insert_method = bulk_insert_method(engine)
+
+    for weblog_lines in read_weblog_lines(source_offset):
+        chunk_index += 1
+        source_offset += len(weblog_lines)
+        weblog_lines = weblog_lines[np.array([len(line.strip()) > 0 for line in weblog_lines], dtype=bool)]
+
+        # Chunk rows, its login counts and its checkpoint are committed together so each chunk is loaded exactly once
+        with engine.begin() as conn:
+            # Lines loaded into a sink before, from re-shipped or overlapping log files, are dropped for that sink.
+            # Lines are hashed as raw text, so only the new lines are parsed and only into the fields the transformation needs
+            if dedup:
+                line_hashes = hash_weblog_lines(weblog_lines)
+                new_lines = find_new_lines(conn, bloom_filters, line_hashes)
+            else:
+                new_lines = {sink: np.ones(len(weblog_lines), dtype=bool) for sink in sinks}
+            chunk_lines = np.logical_or.reduce(list(new_lines.values()))
+            transformed_weblogs = transform_weblogs(parse_weblog_lines(weblog_lines[chunk_lines]), country_timezone_mapping)
+
+            # Counts are aggregated while the chunk streams through, so they scale with the number of groups rather than log lines
+            user_login_counts = aggregate_weblogs(transformed_weblogs[new_lines['aggregate'][chunk_lines]])
+
+            if not aggregate_only:
+                raw_weblogs = transformed_weblogs[new_lines['raw'][chunk_lines]]
+                if partitioned:
+                    create_weblogs_partitions(conn, raw_weblogs['login_time'])
+                raw_weblogs.to_sql('user_weblogs', con=conn, if_exists='append', index = False, schema='dbo', method=insert_method)
+                build_login_facts(conn, key_caches, raw_weblogs).to_sql('fact_driver_login', con=conn, if_exists='append', index=False, schema='dbo', method=insert_method)
+            user_login_counts.to_sql('agg_user_logins_hourly', con=conn, if_exists='append', index=False, schema='dbo', method=upsert_counts, chunksize=10000)
+            aggregate_device_logins(user_login_counts).to_sql('agg_driver_logins_hourly', con=conn, if_exists='append', index=False, schema='dbo', method=upsert_counts, chunksize=10000)
+            if dedup:
+                for sink in sinks:
+                    pd.DataFrame({'line_hash': line_hashes[new_lines[sink]]}).to_sql(DEDUP_SINKS[sink][1], con=conn, if_exists='append', index=False, schema='dbo', method=insert_method)
+            save_checkpoint(conn, chunk_index, source_offset)
+
+        if dedup:
+            for sink in sinks:
+                bloom_add(bloom_filters[sink], line_hashes[new_lines[sink]])
 
     with engine.begin() as conn:
-        conn.execute(command[1])
+        if dedup:
+            for sink in sinks:
+                save_dedup_filter(conn, sink, bloom_filters[sink])
+        conn.execute(command[2])
 
-def main():
+def main(archive_before, aggregate_only, no_dedup, dedup_capacity, dedup_error_rate):
     # target database
     database_name = 'target'
 
-    engine = create_engine(
-    f"postgresql://{DB_USER}:%s@{DB_HOST}:{DB_PORT}/{database_name}" % urllib.parse.quote(DB_PASS))
+    engine = create_warehouse_engine(database_name)
+
+    load_logs_to_dw(engine, aggregate_only, not no_dedup, int(dedup_capacity), float(dedup_error_rate))
 
-    transformed_weblogs = transform_weblogs()
-    load_logs_to_dw(transformed_weblogs, engine)
+    if archive_before is not None:
+        archive_weblogs_partitions(engine, archive_before)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    opt = docopt(__doc__)
+    main(opt["--archive_before"], opt["--aggregate_only"], opt["--no_dedup"], opt["--dedup_capacity"], opt["--dedup_error_rate"])
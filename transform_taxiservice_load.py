@@ -3,13 +3,22 @@
 # Author: Karanpreet Kaur
 # date: 2022-09-05
 
-"""Transform and Load taxi service data"""
+"""Transform and Load taxi service data
+
+Usage: transform_taxiservice_load.py [--rides_since =<rides_since>]
+
+Options:
+--rides_since =<rides_since>  (Optional argument) Only extract cab rides that started on or after this date, e.g. 2021-01-01, and update them in place of the full snapshot (by default all cab rides are loaded)
+"""
 import pandas as pd
 import psycopg2
 import os
 from dotenv import load_dotenv
 import urllib.parse
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from docopt import docopt
+from warehouse_backends import create_warehouse_engine, bulk_insert_method
+from star_schema import create_star_schema, warm_key_caches, upsert_drivers, build_cab_ride_facts
 
 # Load environment file
 load_dotenv()
@@ -21,22 +30,37 @@ DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PORT = os.environ.get("DB_PORT")
 
-def transform_taxiservice_tables(engine):
-    """ Transformation of taxi service data for reporting """
+# Source columns the load writes to the target tables, every column they keep, so the projection only pins the column list
+SOURCE_COLUMNS = {
+    'driver': ['id', 'first_name', 'last_name', 'birth_date', 'driver_license_number', 'expiry_date', 'working'],
+    'cab_ride': ['id', 'shift_id', 'ride_start_time', 'ride_end_time', 'address_starting_point', 'GPS_starting_point', 'address_destination', 'GPS_destination', 'canceled', 'payment_type_id', 'price']
+}
 
-    driver_query = '''SELECT * FROM dbo.driver'''
-    cabride_query = '''SELECT * FROM dbo.cab_ride'''
+def source_filters(rides_since=None):
+    """ Row filters of the source tables with their parameters, evaluated by the source database """
+    filters = {'driver': (None, {}), 'cab_ride': (None, {})}
+    if rides_since is not None:
+        filters['cab_ride'] = ("ride_start_time >= :rides_since", {"rides_since": rides_since.to_pydatetime()})
 
-    try:
-        with engine.begin() as conn:
-            result = conn.execute(driver_query)
-            driver_details = result.fetchall()
+    return filters
 
-            result = conn.execute(cabride_query)
-            cabride_details = result.fetchall()
+def extract_source_table(conn, table_name, columns, row_filter=None, params=None):
+    """ Selected columns of the source table rows matching row_filter """
+    query = f"SELECT {', '.join(columns)} FROM dbo.{table_name}"
+    if row_filter is not None:
+        query += f" WHERE {row_filter}"
 
-        driver_details = pd.DataFrame(driver_details, columns=['id', 'first_name', 'last_name', 'birth_date', 'driver_license_number', 'expiry_date', 'working'])
-        cabride_details = pd.DataFrame(cabride_details, columns=['id', 'shift_id', 'ride_start_time', 'ride_end_time', 'address_starting_point', 'GPS_starting_point', 'address_destination', 'GPS_destination', 'canceled', 'payment_type_id', 'price'])
+    result = conn.execute(text(query), params or {})
+    return pd.DataFrame(result.fetchall(), columns=columns)
+
+def transform_taxiservice_tables(engine, rides_since=None):
+    """ Transformation of taxi service data for reporting """
+    filters = source_filters(rides_since)
+
+    try:
+        with engine.begin() as conn:
+            driver_details = extract_source_table(conn, 'driver', SOURCE_COLUMNS['driver'], *filters['driver'])
+            cabride_details = extract_source_table(conn, 'cab_ride', SOURCE_COLUMNS['cab_ride'], *filters['cab_ride'])
 
         conn.close()
         return driver_details, cabride_details
@@ -45,8 +69,18 @@ def transform_taxiservice_tables(engine):
         print(error)
             
 
-def load_taxiservice_to_dw(transformed_taxi_service_orders, engine):
-    """Load transformed weblogs into target datawarehouse in dbo schema"""
+def aggregate_cab_rides(cabride_details):
+    """ Canceled and total ride counts per ride start date """
+    cab_ride_counts = pd.DataFrame({
+        'ride_date': pd.to_datetime(cabride_details['ride_start_time']).dt.date,
+        'n_canceled_rides': (cabride_details['canceled'] == True).astype(int)
+    })
+    return cab_ride_counts.groupby('ride_date').agg(n_canceled_rides=('n_canceled_rides', 'sum'), n_rides=('n_canceled_rides', 'size')).reset_index()
+
+def load_taxiservice_to_dw(transformed_taxi_service_orders, engine, rides_since=None):
+    """Load transformed weblogs into target datawarehouse in dbo schema. With rides_since the cab rides are the ones
+    started since that day only, they replace the loaded rides, ride counts and facts of that window and keep the older ones.
+    """
     command = (
         """
         DROP TABLE IF EXISTS dbo.driver CASCADE;
@@ -61,22 +95,28 @@ def load_taxiservice_to_dw(transformed_taxi_service_orders, engine):
         )
         """,
         """
-        DROP TABLE IF EXISTS dbo.cab_ride CASCADE;
         CREATE TABLE IF NOT EXISTS dbo.cab_ride (
-            id SERIAL PRIMARY KEY,
+            id INTEGER PRIMARY KEY,
             shift_id INTEGER NOT NULL,
             ride_start_time TIMESTAMP NOT NULL,
             ride_end_time TIMESTAMP NOT NULL,
             address_starting_point TEXT NOT NULL,
-            GPS_starting_point TEXT NOT NULL,
+            "GPS_starting_point" TEXT NOT NULL,
             address_destination TEXT NOT NULL,
-            GPS_destination TEXT NOT NULL,
+            "GPS_destination" TEXT NOT NULL,
             canceled BOOLEAN,
             payment_type_id INTEGER NOT NULL,
             price DECIMAL(10, 2) NOT NULL CHECK (price > 0) 
         )
         """,
         """
+        CREATE TABLE IF NOT EXISTS dbo.agg_cab_rides_daily (
+            ride_date DATE PRIMARY KEY,
+            n_canceled_rides BIGINT NOT NULL,
+            n_rides BIGINT NOT NULL
+        )
+        """,
+        """
         CREATE OR REPLACE VIEW dbo.vw_working_driver_expirylicense AS 
         SELECT 
             id,
@@ -89,37 +129,77 @@ def load_taxiservice_to_dw(transformed_taxi_service_orders, engine):
         """
         CREATE OR REPLACE VIEW dbo.vw_percentage_canceled_rides AS 
         SELECT 
-	            ROUND(CAST(SUM(CASE WHEN canceled IS true THEN 1 ELSE 0 END)::float/COUNT(*) AS NUMERIC), 2) AS percentage_canceled_rides
-        FROM dbo.cab_ride
+	            ROUND(CAST(SUM(n_canceled_rides)::float/NULLIF(SUM(n_rides), 0) AS NUMERIC), 2) AS percentage_canceled_rides
+        FROM dbo.agg_cab_rides_daily
         """
     )
 
+    insert_method = bulk_insert_method(engine)
+    cab_ride_ids = [int(cab_ride_id) for cab_ride_id in transformed_taxi_service_orders[1]['id']]
+
+    # Ride counts are rebuilt from the loaded rides in the same transaction. Cab rides are loaded as a full snapshot,
+    # or with rides_since, rides of the window and rides extracted again are replaced and older ones kept.
+    # Tables are appended to after their own DDL, so keys, constraints and column types are kept
     with engine.begin() as conn:
         conn.execute(command[0])
-        conn.execute(command[1])
-    transformed_taxi_service_orders[0].to_sql('driver', con=engine, if_exists='replace', index = False, schema='dbo')
-    transformed_taxi_service_orders[1].to_sql('cab_ride', con=engine, if_exists='replace', index = False, schema='dbo')
+        transformed_taxi_service_orders[0].to_sql('driver', con=conn, if_exists='append', index = False, schema='dbo', method=insert_method)
+        conn.execute(command[2])
+        if rides_since is None:
+            conn.execute("DROP TABLE IF EXISTS dbo.cab_ride CASCADE")
+            conn.execute(command[1])
+            transformed_taxi_service_orders[1].to_sql('cab_ride', con=conn, if_exists='append', index = False, schema='dbo', method=insert_method)
+            conn.execute("DELETE FROM dbo.agg_cab_rides_daily")
+            cab_ride_counts = aggregate_cab_rides(transformed_taxi_service_orders[1])
+        else:
+            conn.execute(command[1])
+            window = {"rides_since": rides_since.to_pydatetime(), "cab_ride_ids": cab_ride_ids}
+            # Days before the window that lose a ride extracted again with a start moved into the window
+            moved_ride_dates = [row[0] for row in conn.execute(text("SELECT DISTINCT CAST(ride_start_time AS DATE) FROM dbo.cab_ride WHERE ride_start_time < :rides_since AND id = ANY(:cab_ride_ids)"), window).fetchall()]
+            conn.execute(text("DELETE FROM dbo.cab_ride WHERE ride_start_time >= :rides_since OR id = ANY(:cab_ride_ids)"), window)
+            transformed_taxi_service_orders[1].to_sql('cab_ride', con=conn, if_exists='append', index = False, schema='dbo', method=insert_method)
+
+            # Counts of the window and of those days are rebuilt from the loaded rides
+            recount = {"rides_since": rides_since.to_pydatetime(), "moved_ride_dates": moved_ride_dates}
+            conn.execute(text("DELETE FROM dbo.agg_cab_rides_daily WHERE ride_date >= CAST(:rides_since AS DATE) OR ride_date = ANY(:moved_ride_dates)"), recount)
+            recounted_rides = pd.read_sql(text("SELECT ride_start_time, canceled FROM dbo.cab_ride WHERE ride_start_time >= :rides_since OR CAST(ride_start_time AS DATE) = ANY(:moved_ride_dates)"), conn, params=recount)
+            cab_ride_counts = aggregate_cab_rides(recounted_rides)
+        cab_ride_counts.to_sql('agg_cab_rides_daily', con=conn, if_exists='append', index=False, schema='dbo', method=insert_method)
+
+    # Driver dimension and cab ride facts with surrogate keys, cab ride facts follow the loaded cab rides
+    with engine.begin() as conn:
+        create_star_schema(conn)
+        key_caches = warm_key_caches(conn)
+        upsert_drivers(conn, key_caches, transformed_taxi_service_orders[0])
+        if rides_since is None:
+            conn.execute("DELETE FROM dbo.fact_cab_ride")
+        else:
+            conn.execute(text("DELETE FROM dbo.fact_cab_ride WHERE cab_ride_id = ANY(:cab_ride_ids) OR cab_ride_id NOT IN (SELECT id FROM dbo.cab_ride)"), {"cab_ride_ids": cab_ride_ids})
+        build_cab_ride_facts(conn, key_caches, transformed_taxi_service_orders[1]).to_sql('fact_cab_ride', con=conn, if_exists='append', index=False, schema='dbo', method=insert_method)
 
     with engine.begin() as conn:
-        conn.execute(command[2])
         conn.execute(command[3])
+        conn.execute(command[4])
     
     conn.close()
 
-def main():
+def main(rides_since):
     database_name = 'taxi_service'
 
     engine = create_engine(
     f"postgresql://{DB_USER}:%s@{DB_HOST}:{DB_PORT}/{database_name}" % urllib.parse.quote(DB_PASS))
 
-    transformed_taxi_service_orders = transform_taxiservice_tables(engine)
+    # Cab rides are extracted and replaced by whole ride start days
+    if rides_since is not None:
+        rides_since = pd.Timestamp(rides_since).normalize()
+
+    transformed_taxi_service_orders = transform_taxiservice_tables(engine, rides_since)
 
     database_name = 'target'
 
-    engine = create_engine(
-    f"postgresql://{DB_USER}:%s@{DB_HOST}:{DB_PORT}/{database_name}" % urllib.parse.quote(DB_PASS))
+    engine = create_warehouse_engine(database_name)
 
-    load_taxiservice_to_dw(transformed_taxi_service_orders, engine)
+    load_taxiservice_to_dw(transformed_taxi_service_orders, engine, rides_since)
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    opt = docopt(__doc__)
+    main(opt["--rides_since"])
\ No newline at end of file
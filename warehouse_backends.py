@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Target datawarehouse backends: PostgreSQL server or an embedded, in-process DuckDB database file"""
+
+import os
+import urllib.parse
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+# Load environment file
+load_dotenv()
+
+# Read connection details
+DB_HOST = os.environ.get("DB_HOST")
+DB_PASS = os.environ.get("DB_PASS")
+DB_NAME = os.environ.get("DB_NAME")
+DB_USER = os.environ.get("DB_USER")
+DB_PORT = os.environ.get("DB_PORT")
+
+# Backend of target datawarehouse (postgresql, duckdb) and directory of embedded database files
+WAREHOUSE_BACKEND = os.environ.get("WAREHOUSE_BACKEND", "postgresql")
+WAREHOUSE_PATH = os.environ.get("WAREHOUSE_PATH", ".")
+
+WAREHOUSE_BACKENDS = ['postgresql', 'duckdb']
+
+
+def create_warehouse_engine(database_name, backend=None):
+    """ Engine of the target datawarehouse database on the configured backend, with the dbo schema in place """
+    backend = WAREHOUSE_BACKEND if backend is None else backend
+
+    if backend == 'postgresql':
+        return create_engine(
+        f"postgresql://{DB_USER}:%s@{DB_HOST}:{DB_PORT}/{database_name}" % urllib.parse.quote(DB_PASS))
+
+    if backend == 'duckdb':
+        # Needs the optional duckdb-engine dependency (poetry install -E duckdb)
+        engine = create_engine(f"duckdb:///{os.path.join(WAREHOUSE_PATH, database_name)}.duckdb")
+        with engine.begin() as conn:
+            conn.execute("CREATE SCHEMA IF NOT EXISTS dbo")
+        return engine
+
+    raise ValueError(f"Unknown warehouse backend {backend}, expected one of {', '.join(WAREHOUSE_BACKENDS)}")
+
+
+def supports_partitions(connectable):
+    """ Declarative table partitioning and partition detach are PostgreSQL only """
+    return connectable.dialect.name == 'postgresql'
+
+
+def surrogate_key_column(conn, table_name, key_column):
+    """ Column definition of an auto incremented integer surrogate key """
+    if conn.dialect.name == 'duckdb':
+        conn.execute(f"CREATE SEQUENCE IF NOT EXISTS dbo.{table_name}_{key_column}_seq")
+        return f"{key_column} INTEGER PRIMARY KEY DEFAULT nextval('dbo.{table_name}_{key_column}_seq')"
+
+    return f"{key_column} SERIAL PRIMARY KEY"
+
+
+def duckdb_bulk_insert(pd_table, conn, keys, data_iter):
+    """ to_sql method handing the rows to DuckDB as a frame scanned in one INSERT, instead of row by row inserts """
+    frame = pd.DataFrame(data_iter, columns=keys)
+    columns = ', '.join(f'"{key}"' for key in keys)
+    dbapi_connection = conn.connection
+    dbapi_connection.register('bulk_insert_frame', frame)
+    try:
+        dbapi_connection.execute(f"INSERT INTO {pd_table.schema}.{pd_table.name} ({columns}) SELECT {columns} FROM bulk_insert_frame")
+    finally:
+        dbapi_connection.unregister('bulk_insert_frame')
+
+
+def bulk_insert_method(connectable):
+    """ Fastest to_sql method of the backend, None for the pandas default """
+    return duckdb_bulk_insert if connectable.dialect.name == 'duckdb' else None
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# Author: agent
+# date: 2026-10-19
+
+"""Drop weblog lines that were loaded before, using persistent Bloom filters of line hashes.
+
+Lines are loaded into two sinks, the raw rows (dbo.user_weblogs and driver login facts) and the
+login counts of the summary tables, and an aggregate only load reaches the second one only. Every
+line loaded into a sink is kept as a 64 bit hash in the line hash table of that sink. The Bloom
+filter of the sink answers "definitely new" for most lines from memory, only lines it reports as
+possibly loaded are checked exactly against the line hash table. The filters have a fixed size for
+their capacity and false positive rate, so memory stays bounded however many lines were loaded.
+"""
+
+import math
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import text, inspect
+
+# Default number of distinct lines the filter is sized for and its false positive rate at that size
+DEDUP_CAPACITY = 10000000
+DEDUP_ERROR_RATE = 0.001
+
+# Line hashes read per batch when a filter is rebuilt from its line hash table
+REBUILD_BATCH_SIZE = 1000000
+
+# Filter id and line hash table of every sink
+DEDUP_SINKS = {
+    'raw': (1, 'weblogs_line_hashes'),
+    'aggregate': (2, 'weblogs_agg_line_hashes')
+}
+
+
+def create_dedup_tables(conn):
+    """ Create the line hash and filter tables if they do not exist yet """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dbo.weblogs_line_hashes (
+            line_hash BIGINT PRIMARY KEY
+        )
+        """)
+
+    # Lines loaded before the sinks were told apart reached the login counts of every load mode
+    if not inspect(conn).has_table('weblogs_agg_line_hashes', schema='dbo'):
+        conn.execute("""
+            CREATE TABLE dbo.weblogs_agg_line_hashes (
+                line_hash BIGINT PRIMARY KEY
+            )
+            """)
+        conn.execute("INSERT INTO dbo.weblogs_agg_line_hashes SELECT line_hash FROM dbo.weblogs_line_hashes")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dbo.weblogs_dedup_filter (
+            filter_id INTEGER PRIMARY KEY,
+            n_bits BIGINT NOT NULL,
+            n_hashes INTEGER NOT NULL,
+            n_line_hashes BIGINT NOT NULL,
+            filter_bits BYTEA NOT NULL,
+            last_updated_time TIMESTAMP
+        )
+        """)
+
+
+def bloom_filter_size(capacity, error_rate):
+    """ Number of bits and hash functions of a Bloom filter for capacity lines at the given false positive rate """
+    n_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    n_hashes = max(1, int(round(n_bits / capacity * math.log(2))))
+    return n_bits, n_hashes
+
+
+def new_bloom_filter(capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE):
+    """ Empty Bloom filter sized for capacity lines at the given false positive rate """
+    n_bits, n_hashes = bloom_filter_size(capacity, error_rate)
+    return {'n_bits': n_bits, 'n_hashes': n_hashes, 'n_line_hashes': 0, 'bits': np.zeros((n_bits + 7) // 8, dtype=np.uint8)}
+
+
+def bloom_positions(bloom_filter, line_hashes):
+    """ Bit positions of every line hash, derived from its two 32 bit halves (double hashing) """
+    line_hashes = np.asarray(line_hashes, dtype=np.int64).view(np.uint64)
+    first_half = line_hashes & np.uint64(0xffffffff)
+    second_half = (line_hashes >> np.uint64(32)) | np.uint64(1)
+    hash_numbers = np.arange(bloom_filter['n_hashes'], dtype=np.uint64)
+    return (first_half[:, None] + hash_numbers[None, :] * second_half[:, None]) % np.uint64(bloom_filter['n_bits'])
+
+
+def bloom_add(bloom_filter, line_hashes):
+    """ Add line hashes to the filter """
+    positions = bloom_positions(bloom_filter, line_hashes).ravel()
+    np.bitwise_or.at(bloom_filter['bits'], (positions >> np.uint64(3)).astype(np.int64), (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+    bloom_filter['n_line_hashes'] += len(line_hashes)
+
+
+def bloom_might_contain(bloom_filter, line_hashes):
+    """ False for line hashes that were definitely not added, True for the ones that possibly were """
+    positions = bloom_positions(bloom_filter, line_hashes)
+    bits = bloom_filter['bits'][(positions >> np.uint64(3)).astype(np.int64)] >> (positions & np.uint64(7)).astype(np.uint8)
+    return (bits & 1).astype(bool).all(axis=1)
+
+
+def hash_weblog_lines(weblog_lines):
+    """ 64 bit hash of the text of every raw weblog line, computed before any field is parsed """
+    return pd.util.hash_array(np.asarray(weblog_lines, dtype=object)).view(np.int64)
+
+
+def rebuild_dedup_filter(conn, sink, capacity, error_rate):
+    """ Bloom filter of all line hashes loaded into the sink """
+    bloom_filter = new_bloom_filter(capacity, error_rate)
+    result = conn.execution_options(stream_results=True).execute(f"SELECT line_hash FROM dbo.{DEDUP_SINKS[sink][1]}")
+    while True:
+        rows = result.fetchmany(REBUILD_BATCH_SIZE)
+        if not rows:
+            break
+        bloom_add(bloom_filter, np.array([row[0] for row in rows], dtype=np.int64))
+
+    return bloom_filter
+
+
+def load_dedup_filter(conn, sink, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE):
+    """ Saved Bloom filter of the sink, rebuilt when its size changed or it misses lines committed after it was saved """
+    filter_id, line_hash_table = DEDUP_SINKS[sink]
+    saved_filter = conn.execute(text("SELECT n_bits, n_hashes, n_line_hashes, filter_bits FROM dbo.weblogs_dedup_filter WHERE filter_id = :filter_id"), {"filter_id": filter_id}).fetchone()
+    n_line_hashes = conn.execute(f"SELECT COUNT(*) FROM dbo.{line_hash_table}").scalar()
+
+    if saved_filter is not None and (saved_filter[0], saved_filter[1], saved_filter[2]) == bloom_filter_size(capacity, error_rate) + (n_line_hashes,):
+        bloom_filter = {'n_bits': saved_filter[0], 'n_hashes': saved_filter[1], 'n_line_hashes': saved_filter[2], 'bits': np.frombuffer(bytes(saved_filter[3]), dtype=np.uint8).copy()}
+    else:
+        print(f"Rebuilding weblogs {sink} dedup filter from {n_line_hashes} line hashes")
+        bloom_filter = rebuild_dedup_filter(conn, sink, capacity, error_rate)
+
+    if bloom_filter['n_line_hashes'] > capacity:
+        logging.warning(' '+ str(datetime.now()) + ' ' + f"weblogs {sink} dedup filter holds {bloom_filter['n_line_hashes']} lines, more than its capacity of {capacity}; its false positive rate is above {error_rate}")
+
+    return bloom_filter
+
+
+def save_dedup_filter(conn, sink, bloom_filter):
+    """ Persist the Bloom filter of the sink for the next load """
+    conn.execute(text("""
+        INSERT INTO dbo.weblogs_dedup_filter (filter_id, n_bits, n_hashes, n_line_hashes, filter_bits, last_updated_time)
+        VALUES (:filter_id, :n_bits, :n_hashes, :n_line_hashes, :filter_bits, :last_updated_time)
+        ON CONFLICT (filter_id) DO UPDATE
+        SET n_bits = EXCLUDED.n_bits,
+            n_hashes = EXCLUDED.n_hashes,
+            n_line_hashes = EXCLUDED.n_line_hashes,
+            filter_bits = EXCLUDED.filter_bits,
+            last_updated_time = EXCLUDED.last_updated_time
+        """), {"filter_id": DEDUP_SINKS[sink][0], "n_bits": bloom_filter['n_bits'], "n_hashes": bloom_filter['n_hashes'], "n_line_hashes": bloom_filter['n_line_hashes'], "filter_bits": bloom_filter['bits'].tobytes(), "last_updated_time": datetime.now()})
+
+
+def find_new_lines(conn, bloom_filters, line_hashes):
+    """ Per sink of bloom_filters, which lines of the chunk were not loaded into it before """
+    # Lines repeated within the chunk are kept once
+    first_lines = ~pd.Series(line_hashes).duplicated().values
+
+    new_lines = {}
+    for sink, bloom_filter in bloom_filters.items():
+        sink_new_lines = first_lines.copy()
+
+        # Lines the filter reports as possibly loaded are checked exactly against the line hashes loaded into the sink
+        possibly_loaded = sink_new_lines & bloom_might_contain(bloom_filter, line_hashes)
+        if possibly_loaded.any():
+            result = conn.execute(text(f"SELECT line_hash FROM dbo.{DEDUP_SINKS[sink][1]} WHERE line_hash = ANY(:line_hashes)"), {"line_hashes": line_hashes[possibly_loaded].tolist()})
+            loaded_line_hashes = np.array([row[0] for row in result.fetchall()], dtype=np.int64)
+            sink_new_lines &= ~np.isin(line_hashes, loaded_line_hashes)
+
+        new_lines[sink] = sink_new_lines
+
+    return new_lines